@@ -5,15 +5,39 @@ import base64
 import tempfile
 import subprocess
 import asyncio
+from functools import lru_cache
 from typing import Tuple, Dict, Any, Optional
 
 import httpx
 
+from app.utils.circuit_breaker import CircuitBreaker, CircuitBreakerConfig
+from app.utils.http_client import ai_http_client
+
 
 def _get_gemini_key() -> str:
     return (os.getenv("GOOGLE_AI_API_KEY", "").strip() or os.getenv("GEMINI_API_KEY", "").strip())
 
 
+# Tope de llamadas simultáneas a Gemini (evita 429/quota en ráfagas de media)
+GEMINI_MAX_CONCURRENCY = max(1, int(os.getenv("GEMINI_MAX_CONCURRENCY", "8") or "8"))
+_GEMINI_SEM = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# Breaker compartido para Gemini (multimodal + vision_extractor): si Gemini está caído,
+# cortamos en µs y el ingest sigue con su fallback en vez de esperar cada timeout.
+GEMINI_BREAKER_FAILS = int(os.getenv("GEMINI_BREAKER_FAILS", "3"))
+GEMINI_BREAKER_COOLDOWN_SEC = int(os.getenv("GEMINI_BREAKER_COOLDOWN_SEC", "90"))
+
+GEMINI_BREAKER = CircuitBreaker(CircuitBreakerConfig(
+    fail_threshold=max(1, GEMINI_BREAKER_FAILS),
+    cooldown_sec=max(10, GEMINI_BREAKER_COOLDOWN_SEC),
+))
+
+
+def is_outage_status(status: int) -> bool:
+    """429/5xx cuentan como caída del proveedor; otros 4xx son problema del request."""
+    return status == 429 or 500 <= status <= 599
+
+
 def _clean_mime(m: str) -> str:
     return (m or "application/octet-stream").split(";")[0].strip().lower()
 
@@ -70,16 +94,29 @@ def is_effectively_empty_text(text_value: str) -> bool:
     return False
 
 
-def _gemini_media_kind(msg_type: str, mime_type: str) -> str:
+@lru_cache(maxsize=256)
+def _classify_ct(mime_type: str) -> str:
+    """
+    "audio" | "image" | "pdf" | "" según el content-type.
+    Hay pocos mimes distintos en la práctica, así que el cache pega casi siempre.
+    """
     mime = (mime_type or "").lower()
-    if msg_type == "audio" or mime.startswith("audio/"):
+    if mime.startswith("audio/"):
         return "audio"
-    if msg_type == "image" or mime.startswith("image/"):
-        return "image"
-    if msg_type == "document" or mime.startswith("application/pdf") or "pdf" in mime:
-        return "document"
     if mime.startswith("image/"):
         return "image"
+    if "pdf" in mime:
+        return "pdf"
+    return ""
+
+
+def _gemini_media_kind(msg_type: str, mime_type: str) -> str:
+    ct_kind = _classify_ct(mime_type or "")
+    if msg_type == "audio" or ct_kind == "audio":
+        return "audio"
+    if msg_type == "image" or ct_kind == "image":
+        return "image"
+    # pdf / document / cualquier otro -> document
     return "document"
 
 
@@ -230,8 +267,8 @@ async def _gemini_generate_with_model(
 
     t0 = asyncio.get_event_loop().time()
     try:
-        async with httpx.AsyncClient(timeout=timeout_sec) as client:
-            r = await client.post(url, json=body)
+        async with _GEMINI_SEM:
+            r = await ai_http_client().post(url, json=body, timeout=timeout_sec)
     except Exception as e:
         return "", {
             "ok": False,
@@ -296,6 +333,11 @@ async def gemini_generate_text_inline(kind: str, media_bytes: bytes, mime_type:
     if not api_key:
         return "", {"ok": False, "reason": "GOOGLE_AI_API_KEY missing"}
 
+    # el breaker se consulta/actualiza una vez por llamada lógica (no por retry ni
+    # entre primary y fallback), igual que STT de Groq
+    if GEMINI_BREAKER.is_open():
+        return "", {"ok": False, "stage": "breaker", "reason": "gemini_breaker_open"}
+
     primary_model = _default_gemini_mm_model()
     fallback_model = _fallback_gemini_mm_model()
     timeout_sec = _gemini_timeout_sec()
@@ -325,6 +367,7 @@ async def gemini_generate_text_inline(kind: str, media_bytes: bytes, mime_type:
         last_text, last_meta = txt, meta
 
         if meta.get("ok") is True:
+            GEMINI_BREAKER.record_success()
             meta.update({
                 "attempts": attempts,
                 "tried_models": tried_models,
@@ -362,6 +405,7 @@ async def gemini_generate_text_inline(kind: str, media_bytes: bytes, mime_type:
             last_text, last_meta = txt, meta
 
             if meta.get("ok") is True:
+                GEMINI_BREAKER.record_success()
                 meta.update({
                     "attempts": attempts,
                     "tried_models": tried_models,
@@ -384,7 +428,10 @@ async def gemini_generate_text_inline(kind: str, media_bytes: bytes, mime_type:
                 continue
             break
 
-    # Falló todo
+    # Falló todo: cuenta como caída solo si el último intento fue red o 429/5xx
+    if last_meta.get("stage") == "http" or is_outage_status(int(last_meta.get("status") or 0)):
+        GEMINI_BREAKER.record_failure()
+
     if isinstance(last_meta, dict):
         last_meta.update({
             "attempts": attempts,
@@ -419,9 +466,15 @@ async def extract_text_from_media(
     use_bytes = media_bytes
     use_mime = mime_clean
 
+    # breaker abierto => ni siquiera convertimos el audio
+    if GEMINI_BREAKER.is_open():
+        meta["stages"]["gemini"] = {"ok": False, "stage": "breaker", "reason": "gemini_breaker_open"}
+        return "", meta
+
     if kind == "audio":
         # WhatsApp casi siempre llega en audio/ogg (OPUS). Convertimos SIEMPRE para robustez.
-        wav_bytes, wav_mime, conv_meta = _ffmpeg_convert_to_wav_16k_mono(media_bytes, mime_clean)
+        # ffmpeg bloquea (subprocess.run): se corre en un thread para no frenar el loop
+        wav_bytes, wav_mime, conv_meta = await asyncio.to_thread(_ffmpeg_convert_to_wav_16k_mono, media_bytes, mime_clean)
         meta["stages"]["audio_convert"] = conv_meta
 
         if conv_meta.get("ok") is True and wav_bytes:
@@ -14,6 +14,7 @@ from sqlalchemy import text
 from app.ai.knowledge_router import router as knowledge_router
 from app.ai.context_builder import build_ai_meta
 from app.db import engine
+from app.routes.whatsapp import invalidate_ai_send_settings
 
 # ✅ TTS
 from app.ai.tts import tts_synthesize
@@ -609,6 +610,7 @@ def update_ai_settings(payload: AISettingsUpdate):
 
         row = _get_settings_row(conn)
 
+    invalidate_ai_send_settings()
     return AISettingsOut(**row)
 
 
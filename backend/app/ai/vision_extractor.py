@@ -8,7 +8,8 @@ import re
 import asyncio
 from typing import Any, Dict, Tuple
 
-import httpx
+from app.ai.multimodal import GEMINI_BREAKER, is_outage_status, _GEMINI_SEM
+from app.utils.http_client import ai_http_client
 
 
 def _get_gemini_key() -> str:
@@ -100,6 +101,9 @@ async def extract_structured_from_media(
     if not api_key:
         return {}, {"ok": False, "reason": "GOOGLE_AI_API_KEY missing"}
 
+    if GEMINI_BREAKER.is_open():
+        return {}, {"ok": False, "stage": "breaker", "reason": "gemini_breaker_open"}
+
     mime_clean = _clean_mime(mime_type)
     model = _model()
     timeout = _timeout_sec()
@@ -120,14 +124,17 @@ async def extract_structured_from_media(
 
     t0 = asyncio.get_event_loop().time()
     try:
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            r = await client.post(url, json=body)
+        async with _GEMINI_SEM:
+            r = await ai_http_client().post(url, json=body, timeout=timeout)
     except Exception as e:
+        GEMINI_BREAKER.record_failure()
         return {}, {"ok": False, "stage": "http", "error": str(e)[:900], "model": model}
 
     latency_ms = int((asyncio.get_event_loop().time() - t0) * 1000)
 
     if r.status_code >= 400:
+        if is_outage_status(r.status_code):
+            GEMINI_BREAKER.record_failure()
         return {}, {
             "ok": False,
             "stage": "gemini",
@@ -138,6 +145,7 @@ async def extract_structured_from_media(
             "latency_ms": latency_ms,
         }
 
+    GEMINI_BREAKER.record_success()
     j = r.json() or {}
     out_text = ""
     try:
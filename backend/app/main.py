@@ -10,6 +10,8 @@ import json
 import os
 import re
 import secrets
+import subprocess
+import tempfile
 import time
 from collections import Counter
 from datetime import datetime, timedelta
@@ -53,7 +55,13 @@ from app.pipeline.wc_sender import wc_send_product
 from app.routes.whatsapp import (
     router as whatsapp_router,
     upload_whatsapp_media,
+    run_status_consumer_forever,
+    close_http_clients as close_whatsapp_http_clients,
+    drain_background_tasks as drain_whatsapp_background_tasks,
+    start_log_listener as start_whatsapp_log_listener,
+    stop_log_listener as stop_whatsapp_log_listener,
 )
+from app.utils.http_client import close_ai_http_client
 from app.routes.social import router as social_router
 
 # ✅ Woo utils (búsqueda UI)
@@ -83,6 +91,8 @@ _wc_cache_sync_task: Optional[asyncio.Task] = None
 _kb_web_sync_task: Optional[asyncio.Task] = None
 _security_key_rotation_stop: Optional[asyncio.Event] = None
 _security_key_rotation_task: Optional[asyncio.Task] = None
+_wa_status_consumer_stop: Optional[asyncio.Event] = None
+_wa_status_consumer_task: Optional[asyncio.Task] = None
 _firebase_admin_app = None
 
 origins = [
@@ -1169,6 +1179,24 @@ async def _startup_security_key_rotation():
     print("[SECURITY_ROTATION] started", cfg)
 
 
+@app.on_event("startup")
+async def _startup_wa_log_listener():
+    # antes del consumer/webhook: los logs de wa.webhook salen por la cola desde acá
+    start_whatsapp_log_listener()
+
+
+@app.on_event("startup")
+async def _startup_wa_status_consumer():
+    global _wa_status_consumer_stop, _wa_status_consumer_task
+
+    if _wa_status_consumer_task and not _wa_status_consumer_task.done():
+        return
+
+    _wa_status_consumer_stop = asyncio.Event()
+    _wa_status_consumer_task = asyncio.create_task(run_status_consumer_forever(_wa_status_consumer_stop))
+    print("[WA_STATUS_CONSUMER] started")
+
+
 @app.on_event("shutdown")
 async def _shutdown_campaign_engine():
     global _campaign_engine_stop, _campaign_engine_task
@@ -1254,6 +1282,36 @@ async def _shutdown_security_key_rotation():
     _security_key_rotation_stop = None
 
 
+@app.on_event("shutdown")
+async def _shutdown_wa_background_tasks():
+    # antes del consumer de statuses: los webhooks en vuelo todavía encolan statuses
+    await drain_whatsapp_background_tasks(timeout=float(os.getenv("WA_SHUTDOWN_DRAIN_SEC", "10")))
+
+
+@app.on_event("shutdown")
+async def _shutdown_wa_status_consumer():
+    global _wa_status_consumer_stop, _wa_status_consumer_task
+
+    if _wa_status_consumer_stop:
+        _wa_status_consumer_stop.set()
+
+    if _wa_status_consumer_task:
+        try:
+            await _wa_status_consumer_task
+        except Exception:
+            pass
+
+    _wa_status_consumer_task = None
+    _wa_status_consumer_stop = None
+
+
+@app.on_event("shutdown")
+async def _shutdown_wa_http_clients():
+    await close_whatsapp_http_clients()
+    await close_ai_http_client()
+    stop_whatsapp_log_listener()
+
+
 # =========================================================
 # MODELS (solo los que son de API/UI)
 # =========================================================
@@ -2493,41 +2551,53 @@ async def wc_cache_sync_now(
 # Media upload (UI)
 # -------------------------
 
+def _convert_webm_to_ogg_sync(content: bytes) -> bytes:
+    with tempfile.TemporaryDirectory() as tmp:
+        in_path = os.path.join(tmp, "in.webm")
+        out_path = os.path.join(tmp, "out.ogg")
+
+        with open(in_path, "wb") as f:
+            f.write(content)
+
+        cmd = ["ffmpeg", "-y", "-i", in_path, "-c:a", "libopus", "-b:a", "24k", "-vn", out_path]
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            err = p.stderr.decode("utf-8", errors="ignore")
+            raise HTTPException(status_code=500, detail=f"ffmpeg convert failed: {err[:900]}")
+
+        with open(out_path, "rb") as f:
+            return f.read()
+
+
 @app.post("/api/media/upload")
 async def upload_media(file: UploadFile = File(...), kind: str = Form("image")):
-    import tempfile
-    import subprocess
 
     kind = (kind or "image").lower().strip()
     if kind not in ("image", "video", "audio", "document"):
         raise HTTPException(status_code=400, detail="Invalid kind")
 
-    content = await file.read()
     mime = (file.content_type or "application/octet-stream").split(";")[0].strip().lower()
     filename = file.filename or "upload"
+    # Todavía en memoria (< umbral de spool de Starlette): se pasan los bytes. Darle el
+    # SpooledTemporaryFile a httpx lo haría volcar a disco en el loop (fileno() para
+    # calcular el largo fuerza rollover()).
+    # Ya en disco: se pasa el file tal cual para no cargarlo entero en memoria; httpx
+    # lo lee sync en bloques de 64KB sobre un tmp local (trade-off aceptado).
+    if getattr(file.file, "_rolled", True):
+        upload_obj = file.file
+    else:
+        upload_obj = await file.read()
 
     # Si suben webm (browser), lo convertimos a ogg/opus para WhatsApp
     if kind == "audio" and mime == "audio/webm":
-        with tempfile.TemporaryDirectory() as tmp:
-            in_path = os.path.join(tmp, "in.webm")
-            out_path = os.path.join(tmp, "out.ogg")
-
-            with open(in_path, "wb") as f:
-                f.write(content)
-
-            cmd = ["ffmpeg", "-y", "-i", in_path, "-c:a", "libopus", "-b:a", "24k", "-vn", out_path]
-            p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if p.returncode != 0:
-                err = p.stderr.decode("utf-8", errors="ignore")
-                raise HTTPException(status_code=500, detail=f"ffmpeg convert failed: {err[:900]}")
-
-            with open(out_path, "rb") as f:
-                content = f.read()
-
+        content = await file.read()
+        # ffmpeg + I/O de archivos temporales fuera del event loop
+        content = await asyncio.to_thread(_convert_webm_to_ogg_sync, content)
         mime = "audio/ogg"
         filename = "audio.ogg"
+        upload_obj = content
 
-    media_id = await upload_whatsapp_media(content, mime)
+    media_id = await upload_whatsapp_media(upload_obj, mime)
     return {"ok": True, "media_id": media_id, "mime_type": mime, "filename": filename, "kind": kind}
 
 
@@ -2,16 +2,19 @@ from __future__ import annotations
 
 import os
 import asyncio
+import hashlib
 import json
 import re
 from datetime import datetime, timedelta
 from typing import Optional, Tuple
 
-import httpx
 from pydantic import BaseModel
 from sqlalchemy import text
 
 from app.db import engine
+from app.utils.circuit_breaker import CircuitBreaker, CircuitBreakerConfig
+from app.utils.http_client import ai_http_client
+from app.utils.ttl_cache import TTLCache
 from app.automation.trigger_engine import execute_incoming_triggers, execute_outgoing_triggers
 
 # IA
@@ -21,10 +24,12 @@ from app.ai.context_builder import build_ai_meta
 
 # Multimodal
 from app.ai.multimodal import (
+    GEMINI_BREAKER,
     extract_text_from_media,
     extract_structured_from_media_for_sales,
     is_effectively_empty_text,
 )
+from app.ai.vision_extractor import _model as _vision_model
 
 # Woo (assistant)
 from app.ai.wc_assistant import handle_wc_if_applicable
@@ -228,10 +233,27 @@ def _get_inbound_wait_settings() -> dict:
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "").strip()
 
+# Tope de transcripciones simultáneas + retries con backoff ante 429/5xx
+GROQ_STT_MAX_CONCURRENCY = max(1, int(os.getenv("GROQ_STT_MAX_CONCURRENCY", "8") or "8"))
+_GROQ_STT_SEM = asyncio.Semaphore(GROQ_STT_MAX_CONCURRENCY)
+_GROQ_STT_BACKOFF_SEC = (0.5, 2.0, 8.0)
+
+GROQ_BREAKER_FAILS = int(os.getenv("GROQ_BREAKER_FAILS", "3"))
+GROQ_BREAKER_COOLDOWN_SEC = int(os.getenv("GROQ_BREAKER_COOLDOWN_SEC", "90"))
+
+_GROQ_STT_BREAKER = CircuitBreaker(CircuitBreakerConfig(
+    fail_threshold=max(1, GROQ_BREAKER_FAILS),
+    cooldown_sec=max(10, GROQ_BREAKER_COOLDOWN_SEC),
+))
+
 async def _groq_transcribe_audio(media_bytes: bytes, mime_type: str) -> tuple[str, dict]:
     if not GROQ_API_KEY:
         return "", {"ok": False, "reason": "GROQ_API_KEY missing"}
 
+    # breaker abierto => sin transcripción; el ingest sigue con el fallback de audio
+    if _GROQ_STT_BREAKER.is_open():
+        return "", {"ok": False, "stage": "breaker", "reason": "groq_breaker_open"}
+
     url = "https://api.groq.com/openai/v1/audio/transcriptions"
     headers = {"Authorization": f"Bearer {GROQ_API_KEY}"}
 
@@ -242,19 +264,78 @@ async def _groq_transcribe_audio(media_bytes: bytes, mime_type: str) -> tuple[st
         "temperature": "0",
     }
 
-    try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.post(url, headers=headers, data=data, files=files)
-    except Exception as e:
-        return "", {"ok": False, "stage": "http", "error": str(e)[:900]}
+    attempt = 0
+    while True:
+        try:
+            # el semáforo solo cubre el request; el backoff se duerme fuera
+            async with _GROQ_STT_SEM:
+                r = await ai_http_client().post(url, headers=headers, data=data, files=files, timeout=60)
+        except Exception as e:
+            _GROQ_STT_BREAKER.record_failure()
+            return "", {"ok": False, "stage": "http", "error": str(e)[:900]}
+
+        retryable = r.status_code == 429 or 500 <= r.status_code <= 599
+        if not retryable or attempt >= len(_GROQ_STT_BACKOFF_SEC):
+            break
+        await asyncio.sleep(_GROQ_STT_BACKOFF_SEC[attempt])
+        attempt += 1
 
     if r.status_code >= 400:
-        return "", {"ok": False, "stage": "transcribe", "status": r.status_code, "body": r.text[:900]}
+        if retryable:
+            _GROQ_STT_BREAKER.record_failure()
+        return "", {"ok": False, "stage": "transcribe", "status": r.status_code, "body": r.text[:900], "attempts": attempt + 1}
 
+    _GROQ_STT_BREAKER.record_success()
     j = r.json() or {}
     return (j.get("text") or "").strip(), {"ok": True, "stage": "transcribe", "model": data["model"]}
 
 
+# =========================================================
+# Cache de resultados STT/visión (reenvíos, broadcasts, reintentos)
+# =========================================================
+
+MEDIA_RESULT_CACHE_TTL_SEC = float(os.getenv("MEDIA_RESULT_CACHE_TTL_SEC", str(7 * 24 * 3600)))
+
+# (tipo, ..., hash del contenido) -> (resultado, meta); solo se cachean resultados ok
+_MEDIA_RESULT_CACHE = TTLCache(maxsize=2048, ttl_sec=MEDIA_RESULT_CACHE_TTL_SEC)
+# media_id -> (hash, mime): un media_id ya visto no se vuelve a descargar si hay hit
+_MEDIA_ID_HASH = TTLCache(maxsize=4096, ttl_sec=MEDIA_RESULT_CACHE_TTL_SEC)
+
+
+def _media_hash(media_bytes: bytes) -> str:
+    return hashlib.blake2b(media_bytes, digest_size=16).hexdigest()
+
+
+# key -> task en vuelo: una ráfaga con el mismo media (broadcast/reenvío) comparte una sola llamada
+_MEDIA_INFLIGHT: dict[tuple, asyncio.Task] = {}
+
+
+async def _cached_media_result(key: tuple, call) -> tuple:
+    hit = _MEDIA_RESULT_CACHE.get(key)
+    if hit is not None:
+        out, meta = hit
+        return out, {**meta, "cache_hit": True}
+
+    task = _MEDIA_INFLIGHT.get(key)
+    if task is not None:
+        # shield: si este caller se cancela, no cancela la llamada del resto
+        out, meta = await asyncio.shield(task)
+        return out, {**(meta or {}), "coalesced": True}
+
+    task = asyncio.ensure_future(call())
+    _MEDIA_INFLIGHT[key] = task
+    try:
+        out, meta = await asyncio.shield(task)
+    finally:
+        if task.done():
+            _MEDIA_INFLIGHT.pop(key, None)
+        else:
+            task.add_done_callback(lambda _t: _MEDIA_INFLIGHT.pop(key, None))
+    if isinstance(meta, dict) and meta.get("ok") is True:
+        _MEDIA_RESULT_CACHE.set(key, (out, meta))
+    return out, meta
+
+
 # =========================================================
 # AI state helpers (Woo)
 # =========================================================
@@ -654,7 +735,8 @@ async def run_ingest(msg: IngestMessage) -> dict:
                     elif t:
                         parts.append(t)
 
-                combined = "\n".join([p for p in parts if p]).strip()
+                # parts solo recibe strings no vacíos: join directo sin lista intermedia
+                combined = "\n".join(parts).strip()
                 if combined:
                     msg.text = combined
                 msg.msg_type = last.get("msg_type") or msg.msg_type
@@ -825,20 +907,39 @@ async def run_ingest(msg: IngestMessage) -> dict:
                 mm_meta: dict = {}
 
                 try:
-                    media_bytes, real_mime = await download_whatsapp_media_bytes(msg.media_id)
-                    stage_meta["stages"]["download"] = {
-                        "ok": bool(media_bytes),
-                        "mime": (real_mime or ""),
-                        "bytes_len": int(len(media_bytes) if media_bytes else 0),
-                    }
+                    # media_id ya procesado => hash conocido; solo se descarga si algún resultado no está en cache
+                    media_bytes: bytes | None = None
+                    known = _MEDIA_ID_HASH.get(msg.media_id)
+                    if known:
+                        media_key, real_mime = known
+                        stage_meta["stages"]["download"] = {"ok": True, "mime": (real_mime or ""), "skipped": "media_id_cached"}
+                    else:
+                        media_bytes, real_mime = await download_whatsapp_media_bytes(msg.media_id)
+                        stage_meta["stages"]["download"] = {
+                            "ok": bool(media_bytes),
+                            "mime": (real_mime or ""),
+                            "bytes_len": int(len(media_bytes) if media_bytes else 0),
+                        }
+                        media_key = _media_hash(media_bytes) if media_bytes else ""
+                        if media_key:
+                            _MEDIA_ID_HASH.set(msg.media_id, (media_key, real_mime))
+
+                    async def _media_bytes() -> bytes:
+                        nonlocal media_bytes
+                        if media_bytes is None:
+                            media_bytes, _m = await download_whatsapp_media_bytes(msg.media_id)
+                        return media_bytes
 
-                    if media_bytes:
+                    if media_key:
                         # 1) Audio -> Groq whisper
                         if msg_type == "audio":
-                            extracted, mm_meta = await _groq_transcribe_audio(
-                                media_bytes=media_bytes,
-                                mime_type=(real_mime or msg.mime_type or "audio/ogg"),
-                            )
+                            async def _stt():
+                                return await _groq_transcribe_audio(
+                                    media_bytes=await _media_bytes(),
+                                    mime_type=(real_mime or msg.mime_type or "audio/ogg"),
+                                )
+
+                            extracted, mm_meta = await _cached_media_result(("stt", media_key), _stt)
                             stage_meta["stages"]["multimodal"] = {
                                 "provider": "groq",
                                 **(mm_meta or {}),
@@ -847,12 +948,18 @@ async def run_ingest(msg: IngestMessage) -> dict:
 
                         # 2) Image/Document
                         else:
-                            try:
-                                vision_obj, vision_meta = await extract_structured_from_media_for_sales(
+                            async def _vision():
+                                # breaker abierto: no tiene sentido descargar el media
+                                if GEMINI_BREAKER.is_open():
+                                    return {}, {"ok": False, "stage": "breaker", "reason": "gemini_breaker_open"}
+                                return await extract_structured_from_media_for_sales(
                                     msg_type=msg_type,
-                                    media_bytes=media_bytes,
+                                    media_bytes=await _media_bytes(),
                                     mime_type=(real_mime or msg.mime_type or "application/octet-stream"),
                                 )
+
+                            try:
+                                vision_obj, vision_meta = await _cached_media_result(("vision", _vision_model(), media_key), _vision)
                             except Exception as e:
                                 vision_obj, vision_meta = {}, {"ok": False, "reason": "vision_exception", "error": str(e)[:500]}
 
@@ -872,19 +979,14 @@ async def run_ingest(msg: IngestMessage) -> dict:
                                 date = rcp.get("date")
                                 payer = rcp.get("payer_name")
 
-                                summary = []
-                                if amount:
-                                    summary.append(f"Pago detectado: {amount} {currency or ''}".strip())
-                                if ref:
-                                    summary.append(f"Ref: {ref}")
-                                if bank:
-                                    summary.append(f"Banco: {bank}")
-                                if date:
-                                    summary.append(f"Fecha: {date}")
-                                if payer:
-                                    summary.append(f"Titular: {payer}")
-
-                                extracted = "\n".join(summary).strip() or "Comprobante de pago recibido."
+                                summary = (
+                                    f"Pago detectado: {amount} {currency or ''}".strip() if amount else "",
+                                    f"Ref: {ref}" if ref else "",
+                                    f"Banco: {bank}" if bank else "",
+                                    f"Fecha: {date}" if date else "",
+                                    f"Titular: {payer}" if payer else "",
+                                )
+                                extracted = "\n".join(x for x in summary if x).strip() or "Comprobante de pago recibido."
 
                                 try:
                                     update_crm_fields(
@@ -905,7 +1007,7 @@ async def run_ingest(msg: IngestMessage) -> dict:
                                         top = cands[0] or {}
                                         nm = (top.get("name") or "").strip()
                                         br = (top.get("brand") or "").strip()
-                                        search_text = " ".join([br, nm]).strip()
+                                        search_text = f"{br} {nm}".strip()
                                 extracted = search_text.strip()
 
                             # 2.b) Fallback text
@@ -914,12 +1016,19 @@ async def run_ingest(msg: IngestMessage) -> dict:
                                 if not mm_cfg.get("mm_enabled", True):
                                     extracted, mm_meta = "", {"ok": False, "reason": "mm_disabled"}
                                 else:
-                                    os.environ["GEMINI_MM_MODEL"] = str(mm_cfg.get("mm_model") or "gemini-2.5-flash").strip()
-                                    extracted, mm_meta = await extract_text_from_media(
-                                        msg_type=msg_type,
-                                        media_bytes=media_bytes,
-                                        mime_type=(real_mime or msg.mime_type or "application/octet-stream"),
-                                    )
+                                    mm_model = str(mm_cfg.get("mm_model") or "gemini-2.5-flash").strip()
+                                    os.environ["GEMINI_MM_MODEL"] = mm_model
+
+                                    async def _mm_text():
+                                        if GEMINI_BREAKER.is_open():
+                                            return "", {"ok": False, "stage": "breaker", "reason": "gemini_breaker_open", "model": mm_model}
+                                        return await extract_text_from_media(
+                                            msg_type=msg_type,
+                                            media_bytes=await _media_bytes(),
+                                            mime_type=(real_mime or msg.mime_type or "application/octet-stream"),
+                                        )
+
+                                    extracted, mm_meta = await _cached_media_result(("mm", mm_model, media_key), _mm_text)
 
                                 stage_meta["stages"]["multimodal"] = {
                                     "provider": mm_cfg.get("mm_provider", "google"),
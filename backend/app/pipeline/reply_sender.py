@@ -3,7 +3,6 @@
 from __future__ import annotations
 
 import os
-import re
 import json
 import asyncio
 from datetime import datetime
@@ -18,6 +17,8 @@ from app.routes.whatsapp import (
     send_whatsapp_text,
     send_whatsapp_media_id,
     upload_whatsapp_media,
+    _get_ai_send_settings,  # cacheado (TTL + invalidate desde /ai/settings), consulta en thread
+    _split_long_text,
 )
 
 # TTS
@@ -249,32 +250,6 @@ def set_extracted_text(conn, message_id: int, extracted_text: str, ai_meta: Opti
 # Settings helpers
 # -------------------------
 
-def _get_ai_send_settings() -> dict:
-    defaults = {"reply_chunk_chars": 480, "reply_delay_ms": 900, "typing_delay_ms": 450}
-    try:
-        with engine.begin() as conn:
-            r = conn.execute(text("""
-                SELECT
-                    COALESCE(reply_chunk_chars, 480) AS reply_chunk_chars,
-                    COALESCE(reply_delay_ms, 900) AS reply_delay_ms,
-                    COALESCE(typing_delay_ms, 450) AS typing_delay_ms
-                FROM ai_settings
-                ORDER BY id ASC
-                LIMIT 1
-            """)).mappings().first()
-
-        if not r:
-            return defaults
-
-        d = dict(r)
-        d["reply_chunk_chars"] = int(max(120, min(int(d.get("reply_chunk_chars") or 480), 2000)))
-        d["reply_delay_ms"] = int(max(0, min(int(d.get("reply_delay_ms") or 900), 15000)))
-        d["typing_delay_ms"] = int(max(0, min(int(d.get("typing_delay_ms") or 450), 15000)))
-        return d
-    except Exception:
-        return defaults
-
-
 def _get_voice_settings() -> dict:
     defaults = {
         "voice_enabled": False,
@@ -353,104 +328,48 @@ def _get_tts_provider_settings() -> dict:
 
 
 # -------------------------
-# Text chunking
+# Public: send AI reply as text chunks
 # -------------------------
 
-def _normalize_text(s: str) -> str:
-    s = (s or "").strip()
-    s = re.sub(r"\r\n", "\n", s)
-    s = re.sub(r"\n{3,}", "\n\n", s)
-    return s.strip()
-
-
-def _split_long_text(text_msg: str, max_chars: int) -> List[str]:
-    text_msg = _normalize_text(text_msg)
-    if not text_msg:
-        return [""]
-
-    if max_chars <= 0:
-        return [text_msg]
-
-    paras = [p.strip() for p in text_msg.split("\n\n") if p.strip()]
-    out: List[str] = []
-    sentence_split_re = re.compile(r"(?<=[\.\!\?])\s+")
-
-    def _push_piece(piece: str):
-        piece = piece.strip()
-        if not piece:
-            return
-        if len(piece) <= max_chars:
-            out.append(piece)
-            return
-
-        sents = sentence_split_re.split(piece)
-        if len(sents) <= 1:
-            i = 0
-            while i < len(piece):
-                chunk = piece[i:i + max_chars].strip()
-                if chunk:
-                    out.append(chunk)
-                i += max_chars
-            return
-
-        buf = ""
-        for s in sents:
-            s = s.strip()
-            if not s:
-                continue
-            cand = (buf + " " + s).strip() if buf else s
-            if len(cand) <= max_chars:
-                buf = cand
-            else:
-                if buf:
-                    out.append(buf)
-                if len(s) <= max_chars:
-                    buf = s
-                else:
-                    j = 0
-                    while j < len(s):
-                        c = s[j:j + max_chars].strip()
-                        if c:
-                            out.append(c)
-                        j += max_chars
-                    buf = ""
-        if buf:
-            out.append(buf)
-
-    buf = ""
-    for p in paras:
-        if not buf:
-            if len(p) <= max_chars:
-                buf = p
-            else:
-                _push_piece(p)
-                buf = ""
-            continue
+def _save_out_text_sync(phone: str, chunk: str) -> int:
+    with engine.begin() as conn:
+        return save_message(
+            conn,
+            phone=phone,
+            direction="out",
+            msg_type="text",
+            text_msg=chunk,
+        )
 
-        cand = (buf + "\n\n" + p).strip()
-        if len(cand) <= max_chars:
-            buf = cand
+
+def _set_send_result_sync(local_out_id: int, wa_resp: dict, wa_message_id: Optional[str]) -> None:
+    with engine.begin() as conn:
+        if wa_resp.get("sent") is True and wa_message_id:
+            set_wa_send_result(conn, local_out_id, wa_message_id, True, "")
         else:
-            out.append(buf)
-            if len(p) <= max_chars:
-                buf = p
-            else:
-                _push_piece(p)
-                buf = ""
+            err = wa_resp.get("whatsapp_body") or wa_resp.get("reason") or wa_resp.get("error") or "WhatsApp send failed"
+            set_wa_send_result(conn, local_out_id, None, False, str(err)[:900])
+
 
-    if buf:
-        out.append(buf)
+async def _send_text_chunk(phone: str, chunk: str) -> tuple[int, dict, Optional[str]]:
+    # engine sync: save/update van en thread para no bloquear el event loop
+    local_out_id = await asyncio.to_thread(_save_out_text_sync, phone, chunk)
 
-    out = [x.strip() for x in out if x.strip()]
-    return out or [""]
+    try:
+        wa_resp = await send_whatsapp_text(phone, chunk)
+    except Exception as e:
+        wa_resp = {"sent": False, "error": str(e)[:900], "reason": "send_exception"}
 
+    if not isinstance(wa_resp, dict):
+        wa_resp = {"sent": False, "reason": "invalid wa_resp"}
+
+    wa_message_id = wa_resp.get("wa_message_id") if wa_resp.get("sent") is True else None
+    await asyncio.to_thread(_set_send_result_sync, local_out_id, wa_resp, wa_message_id)
+    return local_out_id, wa_resp, wa_message_id
 
-# -------------------------
-# Public: send AI reply as text chunks
-# -------------------------
 
 async def send_ai_reply_in_chunks(phone: str, full_text: str) -> dict:
-    s = _get_ai_send_settings()
+    s = await _get_ai_send_settings()
     max_chars = int(s.get("reply_chunk_chars") or 480)
     reply_delay = int(s.get("reply_delay_ms") or 900) / 1000.0
     typing_delay = int(s.get("typing_delay_ms") or 450) / 1000.0
@@ -466,40 +385,22 @@ async def send_ai_reply_in_chunks(phone: str, full_text: str) -> dict:
     last_wa_resp: dict = {"sent": False, "reason": "no chunks"}
 
     for idx, chunk in enumerate(chunks):
-        with engine.begin() as conn:
-            local_out_id = save_message(
-                conn,
-                phone=phone,
-                direction="out",
-                msg_type="text",
-                text_msg=chunk,
+        if idx < len(chunks) - 1 and reply_delay > 0:
+            # el envío corre mientras transcurre el delay; el siguiente chunk sale
+            # recién cuando ambos terminan, así el orden de envío se mantiene
+            (local_out_id, last_wa_resp, wa_message_id), _ = await asyncio.gather(
+                _send_text_chunk(phone, chunk),
+                asyncio.sleep(reply_delay),
             )
-        local_ids.append(local_out_id)
-
-        try:
-            wa_resp = await send_whatsapp_text(phone, chunk)
-        except Exception as e:
-            wa_resp = {"sent": False, "error": str(e)[:900], "reason": "send_exception"}
-
-        last_wa_resp = wa_resp if isinstance(wa_resp, dict) else {"sent": False, "reason": "invalid wa_resp"}
+        else:
+            local_out_id, last_wa_resp, wa_message_id = await _send_text_chunk(phone, chunk)
 
-        wa_message_id = None
-        if isinstance(last_wa_resp, dict) and last_wa_resp.get("sent") is True:
+        local_ids.append(local_out_id)
+        if last_wa_resp.get("sent") is True:
             sent_any = True
-            wa_message_id = last_wa_resp.get("wa_message_id")
             if wa_message_id:
                 wa_ids.append(str(wa_message_id))
 
-        with engine.begin() as conn:
-            if last_wa_resp.get("sent") is True and wa_message_id:
-                set_wa_send_result(conn, local_out_id, wa_message_id, True, "")
-            else:
-                err = last_wa_resp.get("whatsapp_body") or last_wa_resp.get("reason") or last_wa_resp.get("error") or "WhatsApp send failed"
-                set_wa_send_result(conn, local_out_id, None, False, str(err)[:900])
-
-        if idx < len(chunks) - 1 and reply_delay > 0:
-            await asyncio.sleep(reply_delay)
-
     return {
         "sent": sent_any,
         "chunks_sent": len(chunks),
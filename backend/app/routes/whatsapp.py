@@ -1,17 +1,24 @@
 import os
-import json
+import sys
 import asyncio
+import logging
+import queue
 import httpx
+import orjson
 import re
-import base64
-from datetime import datetime
-from typing import Optional, Tuple
+import time
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import BinaryIO, Optional, Tuple
 
 from fastapi import APIRouter, Request, Response, HTTPException
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy import text
 
 from app.db import engine  # ✅ usa SOLO este engine
+from app.utils.ttl_cache import TTLCache
 
 router = APIRouter()
 
@@ -19,6 +26,78 @@ VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "")
 FORWARD_URLS = os.getenv("WHATSAPP_FORWARD_URLS", "")
 FORWARD_ENABLED = os.getenv("WHATSAPP_FORWARD_ENABLED", "true").lower() == "true"
 FORWARD_TIMEOUT = float(os.getenv("WHATSAPP_FORWARD_TIMEOUT", "3"))
+FORWARD_CONCURRENCY = max(1, int(os.getenv("WHATSAPP_FORWARD_CONCURRENCY", "8")))
+# reintentos ante error de red / 5xx del target, con backoff exponencial (0.5s, 1s, 2s...)
+FORWARD_RETRIES = max(0, int(os.getenv("WHATSAPP_FORWARD_RETRIES", "2")))
+FORWARD_BACKOFF_SEC = float(os.getenv("WHATSAPP_FORWARD_BACKOFF_SEC", "0.5"))
+
+# Timeouts HTTP (connect corto: DNS/TCP lento falla rápido en vez de agotar el read)
+WA_HTTP_CONNECT_TIMEOUT = float(os.getenv("WA_HTTP_CONNECT_TIMEOUT", "3"))
+WA_HTTP_READ_TIMEOUT = float(os.getenv("WA_HTTP_READ_TIMEOUT", "15"))
+WA_HTTP_MEDIA_TIMEOUT = float(os.getenv("WA_HTTP_MEDIA_TIMEOUT", "30"))
+WA_HTTP_POOL_TIMEOUT = float(os.getenv("WA_HTTP_POOL_TIMEOUT", "2"))
+
+GRAPH_TIMEOUT = httpx.Timeout(
+    connect=WA_HTTP_CONNECT_TIMEOUT,
+    read=WA_HTTP_READ_TIMEOUT,
+    write=WA_HTTP_READ_TIMEOUT,
+    pool=WA_HTTP_POOL_TIMEOUT,
+)
+MEDIA_TIMEOUT = httpx.Timeout(
+    connect=WA_HTTP_CONNECT_TIMEOUT,
+    read=WA_HTTP_MEDIA_TIMEOUT,
+    write=WA_HTTP_MEDIA_TIMEOUT,
+    pool=WA_HTTP_POOL_TIMEOUT,
+)
+# forward: pool corto para fallar rápido si los límites están agotados
+FORWARD_HTTP_TIMEOUT = httpx.Timeout(
+    connect=2.0,
+    read=FORWARD_TIMEOUT,
+    write=FORWARD_TIMEOUT,
+    pool=0.5,
+)
+
+# Clientes HTTP compartidos (keep-alive: evita TCP+TLS handshake por envío).
+# Graph lleva el Authorization en el cliente; forward va a otros hosts y usa su propio pool.
+_GRAPH_CLIENT: httpx.AsyncClient | None = None
+_FORWARD_CLIENT: httpx.AsyncClient | None = None
+
+
+def _graph_client() -> httpx.AsyncClient:
+    global _GRAPH_CLIENT
+    if _GRAPH_CLIENT is None or _GRAPH_CLIENT.is_closed:
+        _GRAPH_CLIENT = httpx.AsyncClient(
+            timeout=GRAPH_TIMEOUT,
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+            headers=AUTH_HEADER,
+        )
+    return _GRAPH_CLIENT
+
+
+def _forward_client() -> httpx.AsyncClient:
+    global _FORWARD_CLIENT
+    if _FORWARD_CLIENT is None or _FORWARD_CLIENT.is_closed:
+        _FORWARD_CLIENT = httpx.AsyncClient(
+            timeout=FORWARD_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=16, keepalive_expiry=60),
+        )
+    return _FORWARD_CLIENT
+
+
+async def close_http_clients() -> None:
+    global _GRAPH_CLIENT, _FORWARD_CLIENT
+    for c in (_GRAPH_CLIENT, _FORWARD_CLIENT):
+        if c is not None and not c.is_closed:
+            try:
+                await c.aclose()
+            except Exception:
+                pass
+    _GRAPH_CLIENT = None
+    _FORWARD_CLIENT = None
+
+
+# Limita cuántos POST de forward corren a la vez (evita PoolTimeout si hay muchos targets)
+_FORWARD_SEM = asyncio.Semaphore(FORWARD_CONCURRENCY)
 
 # Token permanente para Cloud API (preferido). Se mantiene fallback a WHATSAPP_TOKEN
 # por compatibilidad con despliegues existentes.
@@ -30,14 +109,80 @@ WHATSAPP_TOKEN = (
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID", "")
 WHATSAPP_GRAPH_VERSION = os.getenv("WHATSAPP_GRAPH_VERSION", "v20.0")
 
+# URLs / headers de Graph: no cambian después del import
+GRAPH_BASE = f"https://graph.facebook.com/{WHATSAPP_GRAPH_VERSION}"
+MESSAGES_URL = f"{GRAPH_BASE}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+MEDIA_URL = f"{GRAPH_BASE}/{WHATSAPP_PHONE_NUMBER_ID}/media"
+AUTH_HEADER = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
+# identity: así aiter_raw() entrega los bytes finales sin pasar por el decoder gzip
+MEDIA_STREAM_HEADERS = {"Accept-Encoding": "identity"}
+# tope para media que se bufferiza entera (STT/OCR); 0 = sin tope
+WA_MEDIA_MAX_BYTES = int(os.getenv("WA_MEDIA_MAX_BYTES", str(16 * 1024 * 1024)))
+
 WA_DEBUG_RAW = os.getenv("WA_DEBUG_RAW", "false").lower() == "true"
 
+# Logging vía cola: el loop solo encola el record; un thread aparte formatea y escribe
+# (sin lock/flush de stdout en el camino del webhook). La cola solo está activa entre
+# start_log_listener()/stop_log_listener() (startup/shutdown de la app); fuera de eso
+# el logger propaga normal a la config de logging de la app.
+log = logging.getLogger("wa.webhook")
+log.setLevel(logging.DEBUG if WA_DEBUG_RAW else logging.INFO)
+_LOG_QUEUE: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_LOG_QUEUE_HANDLER = QueueHandler(_LOG_QUEUE)
+_LOG_LISTENER: QueueListener | None = None
+
+
+def start_log_listener() -> None:
+    """Startup: el listener escribe en los handlers de root (config de la app) o en stderr."""
+    global _LOG_LISTENER
+    if _LOG_LISTENER is not None:
+        return
+
+    handlers = list(logging.getLogger().handlers)
+    if not handlers:
+        stream = logging.StreamHandler(sys.stderr)
+        stream.setFormatter(logging.Formatter("%(message)s"))
+        handlers = [stream]
+
+    _LOG_LISTENER = QueueListener(_LOG_QUEUE, *handlers, respect_handler_level=True)
+    _LOG_LISTENER.start()
+    if _LOG_QUEUE_HANDLER not in log.handlers:
+        log.addHandler(_LOG_QUEUE_HANDLER)
+    # los records ya llegan a esos handlers vía el listener: sin propagar para no duplicar
+    log.propagate = False
+
+
+def stop_log_listener() -> None:
+    """Shutdown: vacía la cola de logs, frena el thread y vuelve a propagar directo."""
+    global _LOG_LISTENER
+    log.removeHandler(_LOG_QUEUE_HANDLER)
+    log.propagate = True
+    listener, _LOG_LISTENER = _LOG_LISTENER, None
+    if listener is None:
+        return
+    try:
+        listener.stop()
+    except Exception:
+        pass
+
+
+# Meta de media (url firmada + mime) es estable mientras dure la URL firmada (~5 min)
+WA_MEDIA_META_TTL_SEC = float(os.getenv("WA_MEDIA_META_TTL_SEC", "240"))
+_MEDIA_META_CACHE = TTLCache(maxsize=4096, ttl_sec=WA_MEDIA_META_TTL_SEC)
+_MEDIA_META_LOCKS: dict[str, asyncio.Lock] = {}
+
+# Meta reintenta webhooks hasta recibir 200 (con backoff que pasa de los 10 min):
+# descartamos wamids / (wamid, status) ya vistos
+WA_SEEN_MAX = int(os.getenv("WA_SEEN_MAX", "16384"))
+WA_SEEN_TTL_SEC = float(os.getenv("WA_SEEN_TTL_SEC", "3600"))
+_SEEN_WAMIDS = TTLCache(maxsize=WA_SEEN_MAX, ttl_sec=WA_SEEN_TTL_SEC)
+
 
 # =========================================================
 # Settings helpers (ai_settings)
 # =========================================================
 
-def _get_ai_send_settings() -> dict:
+def _get_ai_send_settings_sync() -> dict:
     defaults = {"reply_chunk_chars": 480, "reply_delay_ms": 900, "typing_delay_ms": 450}
     try:
         with engine.begin() as conn:
@@ -62,63 +207,117 @@ def _get_ai_send_settings() -> dict:
         return defaults
 
 
+# Cambian muy rara vez: TTL corto para no ir a Postgres en cada envío humanizado
+_AI_SETTINGS_TTL = 5.0
+_AI_SETTINGS_CACHE: dict = {"v": None, "t": 0.0}
+
+
+def invalidate_ai_send_settings() -> None:
+    _AI_SETTINGS_CACHE["v"] = None
+
+
+async def _get_ai_send_settings() -> dict:
+    now = time.monotonic()
+    if _AI_SETTINGS_CACHE["v"] is not None and now - _AI_SETTINGS_CACHE["t"] < _AI_SETTINGS_TTL:
+        return _AI_SETTINGS_CACHE["v"]
+
+    # engine sync: la consulta va en un thread para no bloquear el event loop
+    d = await asyncio.to_thread(_get_ai_send_settings_sync)
+    _AI_SETTINGS_CACHE["v"] = d
+    _AI_SETTINGS_CACHE["t"] = now
+    return d
+
+
 # =========================================================
 # WhatsApp utils
 # =========================================================
 
+def _body_text(r: httpx.Response, limit: int | None = None) -> str:
+    """
+    Cuerpo de error como texto: decode directo de los bytes (sin detección de charset de r.text).
+    """
+    body = r.content or b""
+    if limit is not None:
+        body = body[:limit]
+    return body.decode("utf-8", errors="replace")
+
+
 def _extract_wa_message_id(resp_json: dict) -> str | None:
     """
     Meta a veces responde:
       - {"messages":[{"id":"..."}]}
       - {"message_id":"..."}  (menos común)
     """
-    try:
-        if isinstance(resp_json, dict):
-            mid = resp_json.get("message_id")
-            if mid:
-                return str(mid)
-
-            msgs = resp_json.get("messages") or []
-            if msgs and isinstance(msgs, list):
-                mid2 = (msgs[0] or {}).get("id")
-                if mid2:
-                    return str(mid2)
-    except Exception:
-        pass
-    return None
+    if not isinstance(resp_json, dict):
+        return None
+    mid = resp_json.get("message_id")
+    if mid:
+        return str(mid)
+    msgs = resp_json.get("messages")
+    if not msgs or not isinstance(msgs, list):
+        return None
+    first = msgs[0]
+    mid = first.get("id") if isinstance(first, dict) else None
+    return str(mid) if mid else None
 
 
 async def send_whatsapp_text(to_phone: str, text_msg: str):
     if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID):
         return {"saved": True, "sent": False, "reason": "WHATSAPP_TOKEN / WHATSAPP_PHONE_NUMBER_ID not set"}
 
-    url = f"https://graph.facebook.com/{WHATSAPP_GRAPH_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
     payload = {
         "messaging_product": "whatsapp",
         "to": to_phone,
         "type": "text",
         "text": {"body": text_msg},
     }
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
 
-    async with httpx.AsyncClient(timeout=15) as client:
-        r = await client.post(url, json=payload, headers=headers)
+    r = await _graph_client().post(MESSAGES_URL, json=payload)
 
     if r.status_code >= 400:
-        return {"saved": True, "sent": False, "whatsapp_status": r.status_code, "whatsapp_body": r.text}
+        return {"saved": True, "sent": False, "whatsapp_status": r.status_code, "whatsapp_body": _body_text(r)}
 
     j = r.json()
     return {"saved": True, "sent": True, "wa_message_id": _extract_wa_message_id(j), "whatsapp": j}
 
 
+_RE_MULTINL = re.compile(r"\n{3,}")
+_RE_SENT_SPLIT = re.compile(r"(?<=[\.\!\?])\s+")
+
+
 def _normalize_text(s: str) -> str:
-    s = (s or "").strip()
-    s = re.sub(r"\r\n", "\n", s)
-    s = re.sub(r"\n{3,}", "\n\n", s)
+    # un solo strip al final: replace/sub no pueden agregar espacios en los bordes
+    s = (s or "").replace("\r\n", "\n")
+    # el regex solo corre si realmente hay 3+ saltos seguidos
+    if "\n\n\n" in s:
+        s = _RE_MULTINL.sub("\n\n", s)
     return s.strip()
 
 
+def _iter_sentences(piece: str):
+    """Equivale a _RE_SENT_SPLIT.split(piece) pero sin materializar la lista."""
+    start = 0
+    for m in _RE_SENT_SPLIT.finditer(piece):
+        yield piece[start:m.start()]
+        start = m.end()
+    yield piece[start:]
+
+
 def _split_long_text(text_msg: str, max_chars: int) -> list[str]:
+    # Caso común: mensaje corto de un solo párrafo -> normalizar/partir no cambiaría nada
+    text_msg = text_msg or ""
+    if len(text_msg) <= max_chars and "\r" not in text_msg and "\n\n" not in text_msg:
+        return [text_msg.strip()]
+    # respuestas plantilla (saludos, disclaimers) se repiten: se cachea el resultado
+    return list(_split_long_text_cached(text_msg, max_chars))
+
+
+@lru_cache(maxsize=256)
+def _split_long_text_cached(text_msg: str, max_chars: int) -> tuple[str, ...]:
+    return tuple(_split_long_text_impl(text_msg, max_chars))
+
+
+def _split_long_text_impl(text_msg: str, max_chars: int) -> list[str]:
     text_msg = _normalize_text(text_msg)
     if not text_msg:
         return [""]
@@ -126,77 +325,82 @@ def _split_long_text(text_msg: str, max_chars: int) -> list[str]:
     if max_chars <= 0:
         return [text_msg]
 
-    paras = [p.strip() for p in text_msg.split("\n\n") if p.strip()]
     out: list[str] = []
-    sentence_split_re = re.compile(r"(?<=[\.\!\?])\s+")
 
+    def _push_fixed(piece: str):
+        # corte a largo fijo; strip solo si el corte cayó sobre espacios (no en cada slice)
+        for i in range(0, len(piece), max_chars):
+            c = piece[i:i + max_chars]
+            if c[0].isspace() or c[-1].isspace():
+                c = c.strip()
+                if not c:
+                    continue
+            out.append(c)
+
+    # Todo lo que entra acá ya viene stripeado (párrafos) y las oraciones salen
+    # stripeadas del split (\s+ es greedy), así que solo los cortes fijos necesitan strip.
     def _push_piece(piece: str):
-        piece = piece.strip()
-        if not piece:
-            return
         if len(piece) <= max_chars:
             out.append(piece)
             return
 
-        sents = sentence_split_re.split(piece)
-        if len(sents) <= 1:
-            i = 0
-            while i < len(piece):
-                chunk = piece[i:i + max_chars].strip()
-                if chunk:
-                    out.append(chunk)
-                i += max_chars
+        if _RE_SENT_SPLIT.search(piece) is None:
+            _push_fixed(piece)
             return
 
-        buf = ""
-        for s in sents:
-            s = s.strip()
-            if not s:
+        # buffer como lista + largo acumulado: join solo al hacer flush (evita O(n²))
+        sent_parts: list[str] = []
+        sent_len = 0
+        for s in _iter_sentences(piece):
+            sep = 1 if sent_parts else 0
+            if sent_len + sep + len(s) <= max_chars:
+                sent_parts.append(s)
+                sent_len += sep + len(s)
                 continue
-            cand = (buf + " " + s).strip() if buf else s
-            if len(cand) <= max_chars:
-                buf = cand
-            else:
-                if buf:
-                    out.append(buf)
-                if len(s) <= max_chars:
-                    buf = s
-                else:
-                    j = 0
-                    while j < len(s):
-                        c = s[j:j + max_chars].strip()
-                        if c:
-                            out.append(c)
-                        j += max_chars
-                    buf = ""
-        if buf:
-            out.append(buf)
-
-    buf = ""
-    for p in paras:
-        if not buf:
-            if len(p) <= max_chars:
-                buf = p
+
+            if sent_parts:
+                out.append(" ".join(sent_parts))
+                sent_parts.clear()
+                sent_len = 0
+            if len(s) <= max_chars:
+                sent_parts.append(s)
+                sent_len = len(s)
             else:
-                _push_piece(p)
-                buf = ""
+                _push_fixed(s)
+        if sent_parts:
+            out.append(" ".join(sent_parts))
+
+    buf_parts: list[str] = []
+    buf_len = 0
+    # scan por índices de "\n\n" (sin armar la lista de párrafos)
+    n = len(text_msg)
+    idx = 0
+    while idx <= n:
+        nxt = text_msg.find("\n\n", idx)
+        end = nxt if nxt >= 0 else n
+        p = text_msg[idx:end].strip()
+        idx = end + 2
+        if not p:
+            continue
+        sep = 2 if buf_parts else 0
+        if buf_len + sep + len(p) <= max_chars:
+            buf_parts.append(p)
+            buf_len += sep + len(p)
             continue
 
-        cand = (buf + "\n\n" + p).strip()
-        if len(cand) <= max_chars:
-            buf = cand
+        if buf_parts:
+            out.append("\n\n".join(buf_parts))
+            buf_parts.clear()
+            buf_len = 0
+        if len(p) <= max_chars:
+            buf_parts.append(p)
+            buf_len = len(p)
         else:
-            out.append(buf)
-            if len(p) <= max_chars:
-                buf = p
-            else:
-                _push_piece(p)
-                buf = ""
+            _push_piece(p)
 
-    if buf:
-        out.append(buf)
+    if buf_parts:
+        out.append("\n\n".join(buf_parts))
 
-    out = [x.strip() for x in out if x.strip()]
     return out or [""]
 
 
@@ -204,7 +408,7 @@ async def send_whatsapp_text_humanized(to_phone: str, text_msg: str) -> dict:
     if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID):
         return {"saved": True, "sent": False, "reason": "WHATSAPP_TOKEN / WHATSAPP_PHONE_NUMBER_ID not set"}
 
-    s = _get_ai_send_settings()
+    s = await _get_ai_send_settings()
     max_chars = int(s.get("reply_chunk_chars") or 480)
     reply_delay = int(s.get("reply_delay_ms") or 900) / 1000.0
     typing_delay = int(s.get("typing_delay_ms") or 450) / 1000.0
@@ -220,15 +424,21 @@ async def send_whatsapp_text_humanized(to_phone: str, text_msg: str) -> dict:
         await asyncio.sleep(typing_delay)
 
     for idx, chunk in enumerate(chunks):
-        last_resp = await send_whatsapp_text(to_phone, chunk)
+        if idx < len(chunks) - 1 and reply_delay > 0:
+            # el POST corre mientras transcurre el delay; el siguiente chunk sale
+            # recién cuando ambos terminan, así el orden de envío se mantiene
+            last_resp, _ = await asyncio.gather(
+                send_whatsapp_text(to_phone, chunk),
+                asyncio.sleep(reply_delay),
+            )
+        else:
+            last_resp = await send_whatsapp_text(to_phone, chunk)
+
         if isinstance(last_resp, dict) and last_resp.get("sent") is True:
             mid = last_resp.get("wa_message_id")
             if mid:
                 wa_ids.append(str(mid))
 
-        if idx < len(chunks) - 1 and reply_delay > 0:
-            await asyncio.sleep(reply_delay)
-
     last_resp["chunks_sent"] = len(chunks)
     last_resp["chunk_message_ids"] = wa_ids
     last_resp["humanized"] = True
@@ -240,23 +450,33 @@ async def send_whatsapp_text_humanized(to_phone: str, text_msg: str) -> dict:
     return last_resp
 
 
-async def upload_whatsapp_media(file_bytes: bytes, mime_type: str) -> str:
+async def upload_whatsapp_media(
+    file_obj: "BinaryIO | bytes | bytearray | memoryview",
+    mime_type: str,
+    filename: str = "upload",
+) -> str:
+    """
+    Sube media a Graph. Acepta bytes o un file-like (ej: UploadFile.file):
+    con file-like httpx lo lee por partes al armar el multipart, sin copia previa.
+    Ojo: esa lectura es sync (en el loop); para un file-like en disco es el costo
+    de no cargarlo entero en memoria.
+    """
     if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID):
         raise HTTPException(status_code=500, detail="WhatsApp credentials not set")
 
-    url = f"https://graph.facebook.com/{WHATSAPP_GRAPH_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/media"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-
     mt = (mime_type or "application/octet-stream").split(";")[0].strip().lower()
 
-    files = {"file": ("upload", file_bytes, mt)}
+    # httpx multipart solo acepta str/bytes o file-like: bytearray/memoryview -> bytes
+    if isinstance(file_obj, (bytearray, memoryview)):
+        file_obj = bytes(file_obj)
+
+    files = {"file": (filename or "upload", file_obj, mt)}
     data = {"messaging_product": "whatsapp", "type": mt}
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post(url, headers=headers, data=data, files=files)
+    r = await _graph_client().post(MEDIA_URL, data=data, files=files, timeout=MEDIA_TIMEOUT)
 
     if r.status_code >= 400:
-        raise HTTPException(status_code=500, detail=f"Media upload failed: {r.status_code} {r.text}")
+        raise HTTPException(status_code=500, detail=f"Media upload failed: {r.status_code} {_body_text(r)}")
 
     j = r.json()
     media_id = j.get("id")
@@ -274,7 +494,6 @@ async def send_whatsapp_media_id(to_phone: str, media_type: str, media_id: str,
     if media_type not in ("image", "video", "audio", "document"):
         return {"saved": True, "sent": False, "reason": f"Unsupported media_type: {media_type}"}
 
-    url = f"https://graph.facebook.com/{WHATSAPP_GRAPH_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
     payload = {
         "messaging_product": "whatsapp",
         "to": to_phone,
@@ -285,13 +504,10 @@ async def send_whatsapp_media_id(to_phone: str, media_type: str, media_id: str,
     if caption and media_type in ("image", "video", "document"):
         payload[media_type]["caption"] = caption
 
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post(url, json=payload, headers=headers)
+    r = await _graph_client().post(MESSAGES_URL, json=payload)
 
     if r.status_code >= 400:
-        return {"saved": True, "sent": False, "whatsapp_status": r.status_code, "whatsapp_body": r.text}
+        return {"saved": True, "sent": False, "whatsapp_status": r.status_code, "whatsapp_body": _body_text(r)}
 
     j = r.json()
     return {"saved": True, "sent": True, "wa_message_id": _extract_wa_message_id(j), "whatsapp": j}
@@ -325,8 +541,6 @@ async def send_whatsapp_interactive_cta_url(
     if not url_to_open:
         return {"saved": True, "sent": False, "reason": "url_to_open is required"}
 
-    url = f"https://graph.facebook.com/{WHATSAPP_GRAPH_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-
     interactive: dict = {
         "type": "cta_url",
         "body": {"text": body_text or " "},
@@ -352,13 +566,10 @@ async def send_whatsapp_interactive_cta_url(
         "interactive": interactive,
     }
 
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post(url, json=payload, headers=headers)
+    r = await _graph_client().post(MESSAGES_URL, json=payload)
 
     if r.status_code >= 400:
-        return {"saved": True, "sent": False, "whatsapp_status": r.status_code, "whatsapp_body": r.text}
+        return {"saved": True, "sent": False, "whatsapp_status": r.status_code, "whatsapp_body": _body_text(r)}
 
     j = r.json()
     return {"saved": True, "sent": True, "wa_message_id": _extract_wa_message_id(j), "whatsapp": j}
@@ -368,25 +579,49 @@ async def send_whatsapp_interactive_cta_url(
 # ✅ Download media bytes from WhatsApp
 # =========================================================
 
+async def _fetch_whatsapp_media_metadata(media_id: str) -> dict:
+    meta_url = f"{GRAPH_BASE}/{media_id}"
+
+    r = await _graph_client().get(meta_url)
+
+    if r.status_code >= 400:
+        raise HTTPException(status_code=502, detail=f"Graph meta failed: {r.status_code} {_body_text(r, 900)}")
+
+    return r.json() or {}
+
+
 async def get_whatsapp_media_metadata(media_id: str) -> dict:
+    """
+    Meta de Graph para un media_id, cacheada por WA_MEDIA_META_TTL_SEC.
+    Un lock por media_id evita que N requests simultáneos pidan la misma meta.
+    """
     if not WHATSAPP_TOKEN:
         raise HTTPException(status_code=500, detail="WHATSAPP_TOKEN not configured")
 
-    meta_url = f"https://graph.facebook.com/{WHATSAPP_GRAPH_VERSION}/{media_id}"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.get(meta_url, headers=headers)
+    cached = _MEDIA_META_CACHE.get(media_id)
+    if cached is not None:
+        return cached
 
-    if r.status_code >= 400:
-        raise HTTPException(status_code=502, detail=f"Graph meta failed: {r.status_code} {r.text[:900]}")
+    lock = _MEDIA_META_LOCKS.setdefault(media_id, asyncio.Lock())
+    try:
+        async with lock:
+            cached = _MEDIA_META_CACHE.get(media_id)
+            if cached is not None:
+                return cached
 
-    return r.json() or {}
+            meta = await _fetch_whatsapp_media_metadata(media_id)
+            if meta.get("url"):
+                _MEDIA_META_CACHE.set(media_id, meta)
+            return meta
+    finally:
+        if not lock.locked():
+            _MEDIA_META_LOCKS.pop(media_id, None)
 
 
-async def download_whatsapp_media_bytes(media_id: str) -> tuple[bytes, str]:
+async def _open_media_stream(media_id: str, headers: dict | None = None) -> tuple[httpx.Response, str]:
     """
-    Returns (bytes, mime_type).
+    Abre el GET del binario en modo stream. Returns (response abierta, mime_type).
+    El caller es responsable de cerrar la response.
     """
     meta = await get_whatsapp_media_metadata(media_id)
     dl_url = meta.get("url")
@@ -395,14 +630,42 @@ async def download_whatsapp_media_bytes(media_id: str) -> tuple[bytes, str]:
     if not dl_url:
         raise HTTPException(status_code=502, detail=f"No url in meta: {str(meta)[:400]}")
 
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-    async with httpx.AsyncClient(timeout=30) as client:
-        r_bin = await client.get(dl_url, headers=headers)
+    client = _graph_client()
+    req = client.build_request("GET", dl_url, headers=headers, timeout=MEDIA_TIMEOUT)
+    r_bin = await client.send(req, stream=True)
 
     if r_bin.status_code >= 400:
-        raise HTTPException(status_code=502, detail=f"Graph download failed: {r_bin.status_code} {r_bin.text[:900]}")
+        body = await r_bin.aread()
+        await r_bin.aclose()
+        raise HTTPException(
+            status_code=502,
+            detail=f"Graph download failed: {r_bin.status_code} {body[:900].decode('utf-8', errors='ignore')}",
+        )
+    return r_bin, ct
+
+
+async def download_whatsapp_media_bytes(media_id: str, max_bytes: int | None = None) -> tuple[bytes, str]:
+    """
+    Returns (bytes, mime_type).
+    Corta con 413 si el archivo supera max_bytes (default WA_MEDIA_MAX_BYTES):
+    STT/OCR no deberían bufferizar archivos arbitrariamente grandes.
+    """
+    limit = WA_MEDIA_MAX_BYTES if max_bytes is None else max_bytes
+    r_bin, ct = await _open_media_stream(media_id)
+    try:
+        clen = r_bin.headers.get("content-length") or ""
+        if limit > 0 and clen.isdigit() and int(clen) > limit:
+            raise HTTPException(status_code=413, detail=f"Media too large: {clen} bytes (max {limit})")
 
-    return (r_bin.content or b""), ct
+        buf = bytearray()
+        async for chunk in r_bin.aiter_bytes(65536):
+            buf += chunk
+            if limit > 0 and len(buf) > limit:
+                raise HTTPException(status_code=413, detail=f"Media too large: >{limit} bytes")
+    finally:
+        await r_bin.aclose()
+
+    return bytes(buf), ct
 
 
 # =========================================================
@@ -431,117 +694,308 @@ def _parse_forward_urls() -> list[str]:
     return urls
 
 
-async def _forward_to_targets(raw_body: bytes):
-    if not FORWARD_ENABLED:
-        return
-    urls = _parse_forward_urls()
+# Targets de forward resueltos una sola vez (vacío si el forward está deshabilitado)
+FORWARD_URLS_LIST: tuple[str, ...] = tuple(_parse_forward_urls()) if FORWARD_ENABLED else ()
+
+
+async def _forward_to_targets(raw_body: bytes, content_type: Optional[str] = None):
+    urls = FORWARD_URLS_LIST
     if not urls:
         return
 
-    headers = {"Content-Type": "application/json", "X-Verane-Forwarded": "1"}
-
-    async def _post_one(client: httpx.AsyncClient, url: str):
-        try:
-            await client.post(url, content=raw_body, headers=headers)
-        except Exception:
-            return
+    # bytes tal cual (sin re-encode), con el Content-Type original y largo explícito
+    headers = {
+        "Content-Type": content_type or "application/json",
+        "Content-Length": str(len(raw_body)),
+        "X-Verane-Forwarded": "1",
+    }
 
-    async with httpx.AsyncClient(timeout=FORWARD_TIMEOUT) as client:
-        await asyncio.gather(*[_post_one(client, u) for u in urls])
+    client = _forward_client()
+
+    async def _post_one(url: str):
+        for attempt in range(FORWARD_RETRIES + 1):
+            async with _FORWARD_SEM:
+                try:
+                    r = await client.post(url, content=raw_body, headers=headers)
+                    if r.status_code < 500:
+                        return
+                except Exception:
+                    pass
+            # el backoff se duerme fuera del semáforo
+            if attempt < FORWARD_RETRIES:
+                await asyncio.sleep(FORWARD_BACKOFF_SEC * (2 ** attempt))
+        log.warning("WA_FORWARD_FAILED: %s", url)
+
+    # shield: si vence el timeout global solo dejamos de esperar; los POST en vuelo
+    # terminan solos (cada uno acotado por FORWARD_HTTP_TIMEOUT) en vez de cancelarse
+    fanout = asyncio.gather(*[_post_one(u) for u in urls])
+    try:
+        await asyncio.wait_for(asyncio.shield(fanout), timeout=FORWARD_TIMEOUT * 2)
+    except asyncio.TimeoutError:
+        log.warning("WA_FORWARD_TIMEOUT: targets: %d", len(urls))
+
+
+# Cada status se aplica con un solo UPDATE ... FROM sobre una lista VALUES (v),
+# en vez de un UPDATE por wa_message_id.
+_STATUS_COLS: dict[str, tuple[str, str]] = {
+    "delivered": ("wa_id", "dt"),
+    "read": ("wa_id", "dt"),
+    "failed": ("wa_id", "wa_error"),
+    "sent": ("wa_id", "dt"),
+}
+
+_STATUS_SQL: dict[str, tuple[str, str]] = {
+    "delivered": (
+        """
+            UPDATE messages
+            SET wa_status='delivered',
+                wa_ts_delivered = COALESCE(wa_ts_delivered, v.dt)
+            FROM v
+            WHERE wa_message_id = v.wa_id
+        """,
+        """
+            UPDATE campaign_recipients
+            SET status = CASE
+                            WHEN LOWER(status) IN ('read', 'replied') THEN status
+                            ELSE 'delivered'
+                         END,
+                delivered_at = COALESCE(delivered_at, v.dt)
+            FROM v
+            WHERE wa_message_id = v.wa_id
+        """,
+    ),
+    "read": (
+        """
+            UPDATE messages
+            SET wa_status='read',
+                wa_ts_read = COALESCE(wa_ts_read, v.dt)
+            FROM v
+            WHERE wa_message_id = v.wa_id
+        """,
+        """
+            UPDATE campaign_recipients
+            SET status = CASE
+                            WHEN LOWER(status) = 'replied' THEN status
+                            ELSE 'read'
+                         END,
+                read_at = COALESCE(read_at, v.dt)
+            FROM v
+            WHERE wa_message_id = v.wa_id
+        """,
+    ),
+    "failed": (
+        """
+            UPDATE messages
+            SET wa_status='failed',
+                wa_error = v.wa_error
+            FROM v
+            WHERE wa_message_id = v.wa_id
+        """,
+        """
+            UPDATE campaign_recipients
+            SET status = 'failed',
+                error = COALESCE(v.wa_error, error)
+            FROM v
+            WHERE wa_message_id = v.wa_id
+        """,
+    ),
+    "sent": (
+        """
+            UPDATE messages
+            SET wa_status='sent',
+                wa_ts_sent = COALESCE(wa_ts_sent, v.dt)
+            FROM v
+            WHERE wa_message_id = v.wa_id
+        """,
+        """
+            UPDATE campaign_recipients
+            SET status = CASE
+                            WHEN LOWER(status) IN ('delivered', 'read', 'replied') THEN status
+                            ELSE 'sent'
+                         END,
+                sent_at = COALESCE(sent_at, v.dt)
+            FROM v
+            WHERE wa_message_id = v.wa_id
+        """,
+    ),
+}
+
+
+def _values_cte(cols: tuple[str, ...], rows: list[dict]) -> tuple[str, dict]:
+    """
+    Arma "WITH v(col, ...) AS (VALUES (:col_0, ...), ...)" + sus parámetros.
+    """
+    params: dict = {}
+    tuples = []
+    for i, row in enumerate(rows):
+        names = []
+        for c in cols:
+            params[f"{c}_{i}"] = row[c]
+            names.append(f":{c}_{i}")
+        tuples.append("(" + ", ".join(names) + ")")
+    return f"WITH v({', '.join(cols)}) AS (VALUES {', '.join(tuples)})", params
+
+
+_UTC = timezone.utc
+
+# Campos útiles del error de Meta; cada uno se recorta antes de serializar
+# para que un payload enorme no se serialice entero solo para cortarlo a 900.
+_WA_ERROR_KEYS = ("code", "title", "message", "error_data")
+_WA_ERROR_FIELD_MAX = 300
+
+
+def _wa_error_text(err) -> str:
+    if not isinstance(err, dict):
+        return str(err)[:900]
+    small: dict = {}
+    for k in _WA_ERROR_KEYS:
+        v = err.get(k)
+        if v is None:
+            continue
+        if k == "error_data" and isinstance(v, dict):
+            v = v.get("details")
+            if v is None:
+                continue
+            small[k] = {"details": str(v)[:_WA_ERROR_FIELD_MAX]}
+        elif isinstance(v, (int, float, bool)):
+            small[k] = v
+        else:
+            small[k] = str(v)[:_WA_ERROR_FIELD_MAX]
+    return orjson.dumps(small).decode("utf-8")[:900]
 
 
-def _update_status_in_db(status_obj: dict):
+def _status_params(status_obj: dict, now: datetime) -> tuple[str, dict] | None:
     wa_id = status_obj.get("id")
     st = (status_obj.get("status") or "").lower().strip()
-    ts = status_obj.get("timestamp")
 
-    if not wa_id or not st:
-        return
-
-    dt = None
-    try:
-        if ts:
-            dt = datetime.utcfromtimestamp(int(ts))
-    except Exception:
-        dt = None
+    if not wa_id or st not in _STATUS_SQL:
+        return None
 
-    wa_error = ""
     if st == "failed":
+        wa_error = ""
         try:
             errs = status_obj.get("errors") or []
             if errs and isinstance(errs, list):
-                wa_error = json.dumps(errs[0], ensure_ascii=False)[:900]
+                wa_error = _wa_error_text(errs[0])
         except Exception:
             wa_error = "failed"
+        return st, {"wa_id": wa_id, "wa_error": wa_error or "failed"}
+
+    # epoch en segundos como string de dígitos; cualquier otra cosa -> now del batch
+    ts = str(status_obj.get("timestamp") or "")
+    # columnas TIMESTAMP sin tz: se guarda UTC naive, igual que antes
+    dt = datetime.fromtimestamp(int(ts), tz=_UTC).replace(tzinfo=None) if ts.isdigit() and len(ts) <= 11 else now
+    return st, {"wa_id": wa_id, "dt": dt}
+
+
+def _update_statuses_in_db(statuses: list) -> None:
+    """
+    Agrupa los statuses por tipo y aplica un UPDATE ... FROM VALUES por tipo
+    (messages + campaign_recipients), todo en una sola transacción.
+    """
+    # orden del ciclo de vida: si llegan sent + delivered juntos, gana el más avanzado
+    buckets: dict[str, list[dict]] = {"sent": [], "delivered": [], "read": [], "failed": []}
+    now = datetime.now(_UTC).replace(tzinfo=None)
+    for s in statuses or []:
+        if not isinstance(s, dict):
+            continue
+        parsed = _status_params(s, now)
+        if not parsed:
+            continue
+        buckets[parsed[0]].append(parsed[1])
+
+    if not any(buckets.values()):
+        return
 
     with engine.begin() as conn:
-        if st == "delivered":
-            conn.execute(text("""
-                UPDATE messages
-                SET wa_status='delivered',
-                    wa_ts_delivered = COALESCE(wa_ts_delivered, :dt)
-                WHERE wa_message_id = :wa_id
-            """), {"wa_id": wa_id, "dt": dt or datetime.utcnow()})
-            conn.execute(text("""
-                UPDATE campaign_recipients
-                SET status = CASE
-                                WHEN LOWER(status) IN ('read', 'replied') THEN status
-                                ELSE 'delivered'
-                             END,
-                    delivered_at = COALESCE(delivered_at, :dt)
-                WHERE wa_message_id = :wa_id
-            """), {"wa_id": wa_id, "dt": dt or datetime.utcnow()})
-
-        elif st == "read":
-            conn.execute(text("""
-                UPDATE messages
-                SET wa_status='read',
-                    wa_ts_read = COALESCE(wa_ts_read, :dt)
-                WHERE wa_message_id = :wa_id
-            """), {"wa_id": wa_id, "dt": dt or datetime.utcnow()})
-            conn.execute(text("""
-                UPDATE campaign_recipients
-                SET status = CASE
-                                WHEN LOWER(status) = 'replied' THEN status
-                                ELSE 'read'
-                             END,
-                    read_at = COALESCE(read_at, :dt)
-                WHERE wa_message_id = :wa_id
-            """), {"wa_id": wa_id, "dt": dt or datetime.utcnow()})
-
-        elif st == "failed":
-            conn.execute(text("""
-                UPDATE messages
-                SET wa_status='failed',
-                    wa_error = :wa_error
-                WHERE wa_message_id = :wa_id
-            """), {"wa_id": wa_id, "wa_error": wa_error or "failed"})
-            conn.execute(text("""
-                UPDATE campaign_recipients
-                SET status = 'failed',
-                    error = COALESCE(:wa_error, error)
-                WHERE wa_message_id = :wa_id
-            """), {"wa_id": wa_id, "wa_error": wa_error or "failed"})
-
-        elif st == "sent":
-            conn.execute(text("""
-                UPDATE messages
-                SET wa_status='sent',
-                    wa_ts_sent = COALESCE(wa_ts_sent, :dt)
-                WHERE wa_message_id = :wa_id
-            """), {"wa_id": wa_id, "dt": dt or datetime.utcnow()})
-            conn.execute(text("""
-                UPDATE campaign_recipients
-                SET status = CASE
-                                WHEN LOWER(status) IN ('delivered', 'read', 'replied') THEN status
-                                ELSE 'sent'
-                             END,
-                    sent_at = COALESCE(sent_at, :dt)
-                WHERE wa_message_id = :wa_id
-            """), {"wa_id": wa_id, "dt": dt or datetime.utcnow()})
-
-
-def _mark_campaign_reply(phone: str) -> None:
+        for st, rows in buckets.items():
+            if not rows:
+                continue
+            cte, params = _values_cte(_STATUS_COLS[st], rows)
+            msg_sql, campaign_sql = _STATUS_SQL[st]
+            conn.execute(text(cte + msg_sql), params)
+            conn.execute(text(cte + campaign_sql), params)
+
+
+# =========================================================
+# Status consumer (cola + batch)
+# =========================================================
+
+STATUS_BATCH_MAX = max(1, int(os.getenv("WA_STATUS_BATCH_MAX", "500")))
+STATUS_BATCH_WAIT_SEC = max(0.0, float(os.getenv("WA_STATUS_BATCH_WAIT_MS", "50")) / 1000.0)
+
+_STATUS_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+
+
+def _dedupe_statuses(statuses: list) -> list:
+    """
+    Descarta (wa_id, status) ya vistos (Meta reintenta webhooks).
+    Corre en el loop: _SEEN_WAMIDS no es thread-safe y el UPDATE va en to_thread.
+    """
+    fresh = []
+    for s in statuses or []:
+        if not isinstance(s, dict):
+            continue
+        seen_key = (s.get("id"), (s.get("status") or "").lower().strip())
+        if seen_key[0] and seen_key[1] in _STATUS_SQL:
+            if seen_key in _SEEN_WAMIDS:
+                continue
+            _SEEN_WAMIDS.set(seen_key, True)
+        fresh.append(s)
+    return fresh
+
+
+def enqueue_statuses(statuses: list) -> list:
+    """
+    Encola statuses para el consumer. Devuelve los que no cupieron (cola llena).
+    """
+    statuses = _dedupe_statuses(statuses)
+    for i, s in enumerate(statuses):
+        try:
+            _STATUS_QUEUE.put_nowait(s)
+        except asyncio.QueueFull:
+            log.warning("WA_STATUS_QUEUE_FULL: overflow: %d", len(statuses) - i)
+            return list(statuses[i:])
+    return []
+
+
+def _drain_status_queue(batch: list) -> list:
+    while len(batch) < STATUS_BATCH_MAX:
+        try:
+            batch.append(_STATUS_QUEUE.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return batch
+
+
+async def _flush_status_batch(batch: list) -> None:
+    try:
+        await asyncio.to_thread(_update_statuses_in_db, batch)
+    except Exception as e:
+        log.error("WA_STATUS_BATCH_ERROR: %s | size: %d", str(e)[:900], len(batch))
+
+
+async def run_status_consumer_forever(stop_event: asyncio.Event) -> None:
+    """
+    Drena la cola de statuses y los escribe en batches (una transacción por batch).
+    El engine es sync (psycopg2): la escritura va en un thread para no bloquear el loop.
+    """
+    while not stop_event.is_set():
+        try:
+            first = await asyncio.wait_for(_STATUS_QUEUE.get(), timeout=1.0)
+        except asyncio.TimeoutError:
+            continue
+
+        if STATUS_BATCH_WAIT_SEC > 0:
+            await asyncio.sleep(STATUS_BATCH_WAIT_SEC)
+        await _flush_status_batch(_drain_status_queue([first]))
+
+    # shutdown: no perder lo que quedó en cola
+    while not _STATUS_QUEUE.empty():
+        await _flush_status_batch(_drain_status_queue([]))
+
+
+def _mark_campaign_reply_sync(phone: str) -> None:
     phone = (phone or "").strip()
     if not phone:
         return
@@ -563,7 +1017,67 @@ def _mark_campaign_reply(phone: str) -> None:
         """), {"phone": phone})
 
 
-def _extract_incoming(m: dict) -> Tuple[str, str, Optional[str], Optional[str]]:
+# Handlers por tipo: (m, msg_type) -> (msg_type, text_msg, media_id, mime_type)
+_Incoming = Tuple[str, str, Optional[str], Optional[str]]
+
+
+def _in_text(m: dict, msg_type: str) -> _Incoming:
+    return "text", (m.get("text") or {}).get("body", "") or "", None, None
+
+
+def _in_interactive(m: dict, msg_type: str) -> _Incoming:
+    inter = m.get("interactive") or {}
+    lr = inter.get("list_reply") or {}
+    br = inter.get("button_reply") or {}
+    text_msg = (
+        lr.get("title") or lr.get("description") or lr.get("id") or
+        br.get("title") or br.get("id") or ""
+    ) or ""
+    return "text", text_msg, None, None
+
+
+def _in_button(m: dict, msg_type: str) -> _Incoming:
+    btn = m.get("button") or {}
+    return "text", (btn.get("text") or btn.get("payload") or "") or "", None, None
+
+
+def _in_media(m: dict, msg_type: str) -> _Incoming:
+    media_obj = m.get(msg_type) or {}
+    mime_type = (media_obj.get("mime_type") or "").strip() or None
+    if mime_type:
+        mime_type = mime_type.split(";")[0].strip().lower()
+    return msg_type, (media_obj.get("caption") or "") or "", media_obj.get("id"), mime_type
+
+
+def _in_location(m: dict, msg_type: str) -> _Incoming:
+    loc = m.get("location") or {}
+    text_msg = f"Ubicación: {loc.get('name') or ''} {loc.get('address') or ''} {loc.get('latitude') or ''},{loc.get('longitude') or ''}"
+    return "text", text_msg, None, None
+
+
+def _in_contacts(m: dict, msg_type: str) -> _Incoming:
+    return "text", "El usuario envió un contacto.", None, None
+
+
+def _in_other(m: dict, msg_type: str) -> _Incoming:
+    # sticker y tipos desconocidos: se conserva el tipo, sin texto
+    return msg_type, "", None, None
+
+
+_INCOMING_HANDLERS = {
+    "text": _in_text,
+    "interactive": _in_interactive,
+    "button": _in_button,
+    "image": _in_media,
+    "video": _in_media,
+    "audio": _in_media,
+    "document": _in_media,
+    "location": _in_location,
+    "contacts": _in_contacts,
+}
+
+
+def _extract_incoming(m: dict) -> _Incoming:
     """
     Returns:
       (msg_type, text_msg, media_id, mime_type)
@@ -573,60 +1087,30 @@ def _extract_incoming(m: dict) -> Tuple[str, str, Optional[str], Optional[str]]:
     - El caption (si existe) se manda en text_msg para que IA lo use si aplica.
     """
     msg_type = (m.get("type") or "text").strip().lower()
-    text_msg = ""
-    media_id = None
-    mime_type = None
-
-    if msg_type == "text":
-        text_msg = (m.get("text") or {}).get("body", "") or ""
-
-    elif msg_type == "interactive":
-        inter = m.get("interactive") or {}
-        lr = inter.get("list_reply") or {}
-        br = inter.get("button_reply") or {}
-        text_msg = (
-            lr.get("title") or lr.get("description") or lr.get("id") or
-            br.get("title") or br.get("id") or ""
-        ) or ""
-        msg_type = "text"
-
-    elif msg_type == "button":
-        btn = m.get("button") or {}
-        text_msg = (btn.get("text") or btn.get("payload") or "") or ""
-        msg_type = "text"
-
-    elif msg_type in ("image", "video", "audio", "document"):
-        media_obj = m.get(msg_type) or {}
-        media_id = media_obj.get("id")
-        text_msg = (media_obj.get("caption") or "") or ""
-        mime_type = (media_obj.get("mime_type") or "").strip() or None
-        if mime_type:
-            mime_type = mime_type.split(";")[0].strip().lower()
-
-    elif msg_type == "sticker":
-        text_msg = ""
-        msg_type = "sticker"
-
-    elif msg_type == "location":
-        loc = m.get("location") or {}
-        text_msg = f"Ubicación: {loc.get('name') or ''} {loc.get('address') or ''} {loc.get('latitude') or ''},{loc.get('longitude') or ''}".strip()
-        msg_type = "text"
-
-    elif msg_type == "contacts":
-        text_msg = "El usuario envió un contacto."
-        msg_type = "text"
-
-    else:
-        text_msg = ""
-
-    text_msg = (text_msg or "").strip()
-    return msg_type, text_msg, media_id, mime_type
+    msg_type, text_msg, media_id, mime_type = _INCOMING_HANDLERS.get(msg_type, _in_other)(m, msg_type)
+    return msg_type, (text_msg or "").strip(), media_id, mime_type
 
 
 # =========================================================
 # Ingest internal call
 # =========================================================
 
+_INGEST = None
+_INGEST_MESSAGE = None
+
+
+def _get_ingest():
+    """
+    Resuelve run_ingest / IngestMessage una sola vez (import diferido: ingest_core
+    importa este módulo vía reply_sender, así que no puede ir arriba).
+    """
+    global _INGEST, _INGEST_MESSAGE
+    if _INGEST is None:
+        from app.pipeline.ingest_core import run_ingest, IngestMessage as CoreIngestMessage
+        _INGEST, _INGEST_MESSAGE = run_ingest, CoreIngestMessage
+    return _INGEST, _INGEST_MESSAGE
+
+
 async def _ingest_internal(
     phone: str,
     msg_type: str,
@@ -639,7 +1123,7 @@ async def _ingest_internal(
     Evita importar app.main (circular imports / doble init / comportamiento raro).
     """
     try:
-        from app.pipeline.ingest_core import run_ingest, IngestMessage as CoreIngestMessage
+        run_ingest, CoreIngestMessage = _get_ingest()
 
         payload = CoreIngestMessage(
             phone=(phone or "").strip(),
@@ -654,12 +1138,9 @@ async def _ingest_internal(
         await run_ingest(payload)
 
     except Exception as e:
-        print(
-            "INGEST_INTERNAL_ERROR:",
-            str(e)[:300],
-            "| phone:", phone,
-            "| type:", msg_type,
-            "| media_id:", (media_id or ""),
+        log.error(
+            "INGEST_INTERNAL_ERROR: %s | phone: %s | type: %s | media_id: %s",
+            str(e)[:300], phone, msg_type, (media_id or ""),
         )
 
 
@@ -667,80 +1148,199 @@ async def _ingest_internal(
 # Webhook receiver
 # =========================================================
 
-@router.post("/api/whatsapp/webhook")
-async def whatsapp_receive(request: Request):
-    raw = await request.body()
+# Respuesta del webhook: constante, se serializa una sola vez
+_OK_BODY = b'{"ok":true}'
 
-    if WA_DEBUG_RAW:
-        print("WA_WEBHOOK_RAW:", raw.decode("utf-8", errors="ignore")[:8000])
-    else:
-        try:
-            d = json.loads(raw.decode("utf-8", errors="ignore") or "{}")
-            entry = (d.get("entry") or [None])[0] or {}
-            change = ((entry.get("changes") or [None])[0] or {})
-            value = (change.get("value") or {})
-            msg_count = len(value.get("messages") or [])
-            st_count = len(value.get("statuses") or [])
-            print(f"WA_WEBHOOK: messages={msg_count} statuses={st_count}")
-        except Exception:
-            print("WA_WEBHOOK: (unparsed)")
+# Referencias a tareas en background (evita que el GC las recoja a mitad de camino)
+_BG_TASKS: set[asyncio.Task] = set()
+
+
+def _log_bg_error(t: asyncio.Task) -> None:
+    if t.cancelled():
+        return
+    e = t.exception()
+    if e is not None:
+        log.error("WA_BG_TASK_ERROR: %s", repr(e)[:900])
+
+
+def _spawn_bg(coro) -> asyncio.Task:
+    t = asyncio.create_task(coro)
+    _BG_TASKS.add(t)
+    t.add_done_callback(_BG_TASKS.discard)
+    t.add_done_callback(_log_bg_error)
+    return t
 
-    # forward (evita loop)
-    if FORWARD_ENABLED and request.headers.get("X-Verane-Forwarded") != "1":
-        await _forward_to_targets(raw)
 
+async def drain_background_tasks(timeout: float = 10.0) -> None:
+    """
+    Shutdown: espera (acotado) a que terminen los webhooks/ingest en vuelo
+    y cancela lo que quede, para no cortarlos a mitad sin aviso.
+    """
+    deadline = time.monotonic() + timeout
+    # en loop: un webhook que termina puede haber lanzado sus tareas de ingest
+    while _BG_TASKS:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            break
+        await asyncio.wait(set(_BG_TASKS), timeout=left)
+    still = list(_BG_TASKS)
+    for t in still:
+        t.cancel()
+    if still:
+        log.warning("WA_BG_TASKS_CANCELLED: %d", len(still))
+
+
+async def _mark_campaign_reply(phone: str) -> None:
+    try:
+        await asyncio.to_thread(_mark_campaign_reply_sync, phone)
+    except Exception:
+        pass
+
+
+async def _resolve_media_mime(media_id: str) -> Optional[str]:
     try:
-        data = json.loads(raw.decode("utf-8", errors="ignore") or "{}")
+        meta = await get_whatsapp_media_metadata(media_id)
+        return (meta.get("mime_type") or "").split(";")[0].strip().lower() or None
     except Exception:
-        return {"ok": True}
+        return None
 
+
+async def _process_webhook(raw: bytes) -> None:
+    if log.isEnabledFor(logging.DEBUG):
+        # slice sobre bytes: solo se decodifica el prefijo que se imprime
+        log.debug("WA_WEBHOOK_RAW: %s", raw[:8000].decode("utf-8", errors="ignore"))
+
+    # un solo parse: el mismo dict sirve para el log y para el procesamiento
     try:
-        entry = (data.get("entry") or [])[0]
-        change = (entry.get("changes") or [])[0]
+        data = orjson.loads(raw or b"{}")
+        entry = (data.get("entry") or [None])[0] or {}
+        change = (entry.get("changes") or [None])[0] or {}
         value = change.get("value") or {}
+        statuses = value.get("statuses") or []
+        messages = value.get("messages") or []
+    except Exception:
+        if not WA_DEBUG_RAW:
+            log.info("WA_WEBHOOK: (unparsed)")
+        return
+
+    if not WA_DEBUG_RAW:
+        log.info("WA_WEBHOOK: messages=%d statuses=%d", len(messages), len(statuses))
 
+    try:
         # 1) Status updates -> DB
-        statuses = value.get("statuses") or []
-        for s in statuses:
-            _update_status_in_db(s)
+        if statuses:
+            overflow = enqueue_statuses(statuses)
+            if overflow:
+                await _flush_status_batch(overflow)
 
         # 2) Incoming messages -> ingest
-        messages = value.get("messages") or []
+        incoming: list[tuple[str, str, Optional[str], Optional[str], Optional[str]]] = []
         for m in messages:
+            wamid = m.get("id")
+            if wamid:
+                if wamid in _SEEN_WAMIDS:
+                    continue
+                _SEEN_WAMIDS.set(wamid, True)
+
             phone = (m.get("from") or "").strip()
             if not phone:
                 continue
 
-            try:
-                _mark_campaign_reply(phone)
-            except Exception:
-                pass
+            incoming.append((phone, *_extract_incoming(m)))
 
-            msg_type, text_msg, media_id, mime_type = _extract_incoming(m)
+        if not incoming:
+            return
 
-            if msg_type in ("audio", "image", "document") and media_id:
-                if not mime_type:
-                    try:
-                        meta = await get_whatsapp_media_metadata(media_id)
-                        mime_type = (meta.get("mime_type") or "").split(";")[0].strip().lower() or None
-                    except Exception:
-                        pass
+        # I/O previo al ingest en paralelo: marca de campaña (una por teléfono)
+        # + mime de los media que no lo traen
+        phones = list(dict.fromkeys(x[0] for x in incoming))
+        need_mime = [
+            i for i, (_p, msg_type, _t, media_id, mime_type) in enumerate(incoming)
+            if msg_type in ("audio", "image", "document") and media_id and not mime_type
+        ]
+        results = await asyncio.gather(
+            *(_mark_campaign_reply(p) for p in phones),
+            *(_resolve_media_mime(incoming[i][3]) for i in need_mime),
+        )
+        mimes = dict(zip(need_mime, results[len(phones):]))
 
-            await _ingest_internal(
+        # el ingest (IA, envíos) no bloquea el resto del webhook. No hay orden garantizado
+        # entre webhooks del mismo teléfono: run_ingest lo resuelve en DB (BATCH_SUPERSEDED)
+        for i, (phone, msg_type, text_msg, media_id, mime_type) in enumerate(incoming):
+            _spawn_bg(_ingest_internal(
                 phone=phone,
                 msg_type=msg_type,
                 text_msg=text_msg or "",
                 media_id=media_id,
-                mime_type=mime_type,
-            )
+                mime_type=mimes.get(i) or mime_type,
+            ))
 
     except Exception as e:
-        print("WEBHOOK_ERROR:", str(e)[:900])
+        log.error("WEBHOOK_ERROR: %s", str(e)[:900])
+
+
+# Los webhooks de WA pesan < 100KB; el tope evita que un sender hostil nos llene la memoria
+WA_WEBHOOK_MAX_BYTES = int(os.getenv("WA_WEBHOOK_MAX_BYTES", "1000000"))
+WA_WEBHOOK_READ_TIMEOUT_SEC = float(os.getenv("WA_WEBHOOK_READ_TIMEOUT_SEC", "10"))
+
+
+async def _read_body_limited(request: Request) -> bytes:
+    clen = request.headers.get("content-length") or ""
+    if clen.isdigit() and int(clen) > WA_WEBHOOK_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
 
-    return {"ok": True}
+    async def _read() -> bytes:
+        buf = bytearray()
+        async for chunk in request.stream():
+            buf += chunk
+            if len(buf) > WA_WEBHOOK_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="Payload too large")
+        return bytes(buf)
+
+    try:
+        return await asyncio.wait_for(_read(), timeout=WA_WEBHOOK_READ_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=408, detail="Request body timeout")
+
+
+@router.post("/api/whatsapp/webhook")
+async def whatsapp_receive(request: Request):
+    """
+    ACK inmediato a Meta: el forward y el procesamiento (DB + ingest) corren en background.
+    """
+    raw = await _read_body_limited(request)
+
+    # forward (evita loop); sin targets o sin body no se crea ninguna tarea
+    if FORWARD_URLS_LIST and raw and request.headers.get("X-Verane-Forwarded") != "1":
+        _spawn_bg(_forward_to_targets(raw, request.headers.get("content-type")))
+
+    # Scan barato de bytes: si no hay messages ni statuses, no hay nada local que parsear
+    if WA_DEBUG_RAW or b'"messages"' in raw or b'"statuses"' in raw:
+        _spawn_bg(_process_webhook(raw))
+    return Response(content=_OK_BODY, media_type="application/json")
 
 
 @router.get("/api/media/proxy/{media_id}")
 async def proxy_media(media_id: str):
-    content, ct = await download_whatsapp_media_bytes(media_id)
-    return StreamingResponse(iter([content]), media_type=ct)
+    """
+    Stream del binario de Graph hacia el cliente (sin bufferizar el archivo completo).
+    """
+    # los headers de la response se resuelven antes de empezar a stremear
+    r_bin, ct = await _open_media_stream(media_id, headers=MEDIA_STREAM_HEADERS)
+
+    async def _gen():
+        try:
+            async for chunk in r_bin.aiter_raw(65536):
+                yield chunk
+        finally:
+            await r_bin.aclose()
+
+    out_headers = {"Cache-Control": "public, max-age=86400"}
+    # aiter_raw() reenvía los bytes tal cual: largo y encoding de Graph siguen siendo válidos
+    for h in ("content-length", "content-encoding"):
+        v = r_bin.headers.get(h)
+        if v:
+            out_headers[h] = v
+    # background: libera la conexión de Graph aunque el cliente corte antes de que
+    # empiece a iterarse _gen() (aclose es idempotente)
+    return StreamingResponse(_gen(), media_type=ct, headers=out_headers, background=BackgroundTask(r_bin.aclose))
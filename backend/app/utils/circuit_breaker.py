@@ -1,6 +1,7 @@
 # app/utils/circuit_breaker.py
 
 from __future__ import annotations
+import threading
 import time
 from dataclasses import dataclass
 
@@ -14,29 +15,42 @@ class CircuitBreaker:
     Breaker simple en memoria (por proceso).
     - Si falla N veces, se abre por cooldown_sec.
     - Mientras esté abierto, se recomienda usar fallback (DB).
+    - Los mutadores van bajo lock: se usa desde el loop y desde workers de to_thread.
+    - El estado NO se comparte entre procesos: el Dockerfile corre un solo worker de
+      uvicorn; si se escala a --workers N, cada worker abre su breaker por separado.
     """
     def __init__(self, cfg: CircuitBreakerConfig | None = None):
         self.cfg = cfg or CircuitBreakerConfig()
+        # tipos normalizados una sola vez: el hot path no castea
+        self._threshold = int(self.cfg.fail_threshold)
+        self._cooldown = int(self.cfg.cooldown_sec)
         self._fails = 0
-        self._open_until = 0
+        # reloj monotónico: un salto de NTP / suspend no deja el breaker trabado
+        self._open_until = 0.0
+        self._lock = threading.Lock()
 
     def is_open(self) -> bool:
-        return int(time.time()) < int(self._open_until or 0)
+        return time.monotonic() < self._open_until
 
     def record_success(self) -> None:
-        self._fails = 0
-        self._open_until = 0
+        with self._lock:
+            self._fails = 0
+            self._open_until = 0.0
 
     def record_failure(self) -> None:
-        self._fails += 1
-        if self._fails >= int(self.cfg.fail_threshold):
-            self._open_until = int(time.time()) + int(self.cfg.cooldown_sec)
+        with self._lock:
+            self._fails += 1
+            if self._fails >= self._threshold:
+                self._open_until = time.monotonic() + self._cooldown
 
     def info(self) -> dict:
+        # open_until se reporta en epoch (wall clock) solo acá
+        remaining = self._open_until - time.monotonic()
+        is_open = remaining > 0
         return {
-            "fails": int(self._fails),
-            "open_until": int(self._open_until or 0),
-            "is_open": bool(self.is_open()),
-            "fail_threshold": int(self.cfg.fail_threshold),
-            "cooldown_sec": int(self.cfg.cooldown_sec),
+            "fails": self._fails,
+            "open_until": int(time.time() + remaining) if is_open else 0,
+            "is_open": is_open,
+            "fail_threshold": self._threshold,
+            "cooldown_sec": self._cooldown,
         }
\ No newline at end of file
@@ -0,0 +1,37 @@
+# app/utils/http_client.py
+
+from __future__ import annotations
+import os
+
+import httpx
+
+# Cliente compartido para proveedores de IA (Gemini, Groq): keep-alive entre llamadas
+# en vez de TCP+TLS handshake por cada media. Cada caller pasa su propio timeout.
+AI_HTTP_MAX_CONNECTIONS = int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "100"))
+AI_HTTP_MAX_KEEPALIVE = int(os.getenv("AI_HTTP_MAX_KEEPALIVE", "50"))
+
+_AI_CLIENT: httpx.AsyncClient | None = None
+
+
+def ai_http_client() -> httpx.AsyncClient:
+    global _AI_CLIENT
+    if _AI_CLIENT is None or _AI_CLIENT.is_closed:
+        _AI_CLIENT = httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=max(1, AI_HTTP_MAX_CONNECTIONS),
+                max_keepalive_connections=max(1, AI_HTTP_MAX_KEEPALIVE),
+                keepalive_expiry=60,
+            ),
+        )
+    return _AI_CLIENT
+
+
+async def close_ai_http_client() -> None:
+    global _AI_CLIENT
+    if _AI_CLIENT is not None and not _AI_CLIENT.is_closed:
+        try:
+            await _AI_CLIENT.aclose()
+        except Exception:
+            pass
+    _AI_CLIENT = None
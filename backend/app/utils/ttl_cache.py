@@ -0,0 +1,51 @@
+# app/utils/ttl_cache.py
+
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """
+    Cache LRU simple en memoria (por proceso) con expiración por entrada.
+    - maxsize: al superarlo se expulsa la entrada usada hace más tiempo.
+    - ttl_sec: segundos de vida de cada entrada desde que se guarda.
+    """
+    def __init__(self, maxsize: int = 1024, ttl_sec: float = 300):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl_sec = float(ttl_sec)
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if time.monotonic() >= expires_at:
+            self._data.pop(key, None)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl_sec, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_MISSING = object()